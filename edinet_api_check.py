@@ -22,32 +22,47 @@ edinet_api_check.py
 import datetime 
 import logging
 logger = logging.getLogger(__name__)
-import tempfile
+import io
+import re
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 from edinet_api_fetch import *
 from edinet_api_parse import *
 import xbrl_edinet
+import edinet_json
 
 class EdinetApiCheckError(RuntimeError):
     pass
 
 class EdinetApiCheckerAbs(metaclass=ABCMeta):
-    def __init__(self, *, retry_interval=-1, history_file=None):
-        self.fetcher = EdinetAPIFetcher(retry_interval=retry_interval)
+    def __init__(self, *, retry_interval=-1, max_retries=10, history_file=None, max_workers=1, doc_list_cache_dir=None):
+        # doc_list_cache_dir を指定すると変更のない書類一覧の再ダウンロードを省く
+        # max_retries は一回の取得あたりの最大 retry 回数 (None なら成功するまで retry する)
+        self.fetcher = EdinetAPIFetcher(retry_interval=retry_interval, max_retries=max_retries, max_workers=max_workers, doc_list_cache_dir=doc_list_cache_dir)
         self.history_file = None if history_file is None else Path(history_file)
+        # _check_one の並列数
+        self.max_workers = max_workers
 
     def check(self, sec_codes=None, days=1):
+        if sec_codes is not None:
+            # _check_one で書類毎に参照するので set にしておく
+            sec_codes = frozenset(sec_codes)
         end_datetime = datetime.datetime.now()
         start_datetime = end_datetime - datetime.timedelta(days=days)
         end_date = end_datetime.date()
         date = start_datetime.date()
+        # 提出日時 ("YYYY-MM-DD hh:mm") を文字列のまま比較するための開始日時
+        # 秒以下がある場合は末尾に ":" を付けて同じ分の提出日時より後ろになるようにする
+        start_str = start_datetime.isoformat(sep=" ", timespec="minutes")
+        if start_datetime.second or start_datetime.microsecond:
+            start_str += ":"
 
         count_h = {} 
         if self.history_file is not None:
             if self.history_file.exists():
-                with open(self.history_file, "r") as f:
-                    count_h = json.load(f)
+                with open(self.history_file, "rb") as f:
+                    count_h = edinet_json.loads(f.read())
 
         result = [] 
         while date <= end_date:
@@ -69,7 +84,11 @@ class EdinetApiCheckerAbs(metaclass=ABCMeta):
             else:
                 skip_count = 0
 
+            targets = []
             for d in j["results"]:
+                # 書類一覧の情報だけで判定できるものは先に除いておく
+                if not self._is_target(d):
+                    continue
                 if d["seqNumber"] <= skip_count:
                     continue
                 if d["submitDateTime"] is None:
@@ -78,66 +97,105 @@ class EdinetApiCheckerAbs(metaclass=ABCMeta):
                     continue
                 else:
                     # 期限外は skip
-                    submit_datetime = datetime.datetime.fromisoformat(d["submitDateTime"])
-                    if submit_datetime < start_datetime:
+                    submit = d["submitDateTime"]
+                    if len(submit) == 16 and submit[10] == " ":
+                        # 通常の形式なら datetime に変換せずに比較する
+                        if submit < start_str:
+                            continue
+                    elif datetime.datetime.fromisoformat(submit) < start_datetime:
                         continue
-                r = self._check_one(d, sec_codes)
-                if r is not None:
-                    result.append(r)
-            # 処理が終わったら update
+                targets.append(d)
+            # 書類毎のチェックは並列に実行 (結果は書類一覧の順に並べる)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for r in executor.map(lambda d: self._check_one(d, sec_codes), targets):
+                    if r is not None:
+                        result.append(r)
+            # その日の書類が全部終わったら update
             count_h[date_key] = j["metadata"]["resultset"]["count"]
             date += datetime.timedelta(days=1)
 
         # 更新後のデータを書き込み 
         if self.history_file is not None:
-            with open(self.history_file, "w") as f:
-                json.dump(count_h, f, indent=2)
+            edinet_json.write_bytes(self.history_file, edinet_json.dumps(count_h, indent=True))
         return result
 
+    def _is_target(self, d):
+        # 書類一覧の項目のみで判定できるチェック対象の条件
+        # _check_one は True の書類に対してのみ呼ばれる
+        return True
+
     @abstractmethod
     def _check_one(self, d):
         pass
 
 # 大量保有報告チェック 
 class EdinetApiHoldingsChecker(EdinetApiCheckerAbs):
-    def _check_one(self, d, sec_codes=None):
+    # 除外する提出事由 (所在地変更, 住所変更)
+    _REASON_EXCLUDE_RE = re.compile("所在地|住所")
+    # 書類の概要から提出事由がわかる場合に除外するもの
+    _DESCRIPTION_EXCLUDE_RE = re.compile("所在地変更|住所変更")
+    # XBRL から取り出す値 {結果のキー : (ns_pre, tag[, context_id])}
+    _FIELDS = {
+        "title" : ("jplvh_cor", "DocumentTitleCoverPage"),
+        "reason" : ("jplvh_cor", "ReasonForFilingChangeReportCoverPage"),
+        "issuer_sec_code" : ("jplvh_cor", "SecurityCodeOfIssuer"),
+        "issuer_name" : ("jplvh_cor", "NameOfIssuer"),
+        "sec_code" : ("jpdei_cor", "SecurityCodeDEI"),
+        "filer_name" : ("jpdei_cor", "FilerNameInJapaneseDEI"),
+        "share_ratio_prev" : ("jplvh_cor", "HoldingRatioOfShareCertificatesEtcPerLastReport", "FilingDateInstant"),
+        "share_ratio" : ("jplvh_cor", "HoldingRatioOfShareCertificatesEtc", "FilingDateInstant"),
+    }
+    # "FilingDateInstant" の保有割合がない場合に context_id 指定無しでとってくる値
+    _FIELDS_FALLBACK = {
+        "share_ratio_prev" : ("jplvh_cor", "HoldingRatioOfShareCertificatesEtcPerLastReport"),
+        "share_ratio" : ("jplvh_cor", "HoldingRatioOfShareCertificatesEtc"),
+    }
+
+    def _is_target(self, d):
         if d["docTypeCode"] != "350": 
-            return None
+            return False
         if "特例対象株券等" in d["docDescription"]:
             # 特例対象株券等は除く
-            return None
+            return False
+        if self._DESCRIPTION_EXCLUDE_RE.search(d["docDescription"]):
+            # 概要に所在地変更, 住所変更とあるものは XBRL を取得するまでもなく除く
+            # 概要でわからないものは _check_one で提出事由を見て判断する
+            return False
+        return True
+
+    def _check_one(self, d, sec_codes=None):
         r = self.fetcher.fetch_doc_one(d["docID"], EdinetAPIFetcher.DOC_TYPE_MAIN)
         if r is None:
             return None
         
-        with tempfile.NamedTemporaryFile() as f:
-            with open(f.name, "wb") as f:
-                f.write(r.content)
-            df = xbrl_edinet.parse_zip(f.name)
-        # デバッグ用
-        #with open(f"a/{d['docID']}.csv", mode="w", encoding="cp932", errors="ignore") as f:
-        #    df.to_csv(f)
+        # 必要な値だけを XBRL から直接取り出す (一時ファイルを介さずメモリ上の zip から読む)
+        fields = self._FIELDS
+        fields_fallback = self._FIELDS_FALLBACK
+        clean_text = DataParserAbs.clean_text
+        texts = xbrl_edinet.extract_fields(io.BytesIO(r.content), [*fields.values(), *fields_fallback.values()])
+        v = {k : None if texts[f] is None else clean_text(texts[f]) for k, f in fields.items()}
+        to_float = lambda t: None if t is None else float(t)
 
         result = {}
         result["id"] = d["docID"]
-        result["title"] = DataParserAbs.get_text(df, "jplvh_cor", "DocumentTitleCoverPage")
+        result["title"] = v["title"]
         result["onset_datetime"] = d["submitDateTime"]
-        result["reason"] = DataParserAbs.get_text(df, "jplvh_cor", "ReasonForFilingChangeReportCoverPage")
-        if result["reason"] is not None and (any([k in result["reason"] for k in ["所在地", "住所"]])):
+        result["reason"] = v["reason"]
+        if result["reason"] is not None and self._REASON_EXCLUDE_RE.search(result["reason"]):
             # 所在地変更, 住所変更 で出してるのは除く。目的が複数のもあるかもしれないが。
             return None
-        result["issuer_sec_code"] = DataParserAbs.get_text(df, "jplvh_cor", "SecurityCodeOfIssuer")
+        result["issuer_sec_code"] = v["issuer_sec_code"]
         if sec_codes is not None and result["issuer_sec_code"] not in sec_codes:
             return None
-        result["issuer_name"] = DataParserAbs.get_text(df, "jplvh_cor", "NameOfIssuer")
-        result["sec_code"] = DataParserAbs.get_text(df, "jpdei_cor", "SecurityCodeDEI")
-        result["filer_name"] = DataParserAbs.get_text(df, "jpdei_cor", "FilerNameInJapaneseDEI")
-        result["share_ratio_prev"] = DataParserAbs.get_float(df, "jplvh_cor", "HoldingRatioOfShareCertificatesEtcPerLastReport", "FilingDateInstant")
-        result["share_ratio"] = DataParserAbs.get_float(df, "jplvh_cor", "HoldingRatioOfShareCertificatesEtc", "FilingDateInstant")
+        result["issuer_name"] = v["issuer_name"]
+        result["sec_code"] = v["sec_code"]
+        result["filer_name"] = v["filer_name"]
+        result["share_ratio_prev"] = to_float(v["share_ratio_prev"])
+        result["share_ratio"] = to_float(v["share_ratio"])
         if result["share_ratio_prev"] is None and result["share_ratio"] is None:
             # "FilingDateInstant" がなかった場合、context_id 指定無しでとってくる
-            result["share_ratio_prev"] = DataParserAbs.get_float(df, "jplvh_cor", "HoldingRatioOfShareCertificatesEtcPerLastReport")
-            result["share_ratio"] = DataParserAbs.get_float(df, "jplvh_cor", "HoldingRatioOfShareCertificatesEtc")
+            for k, f in fields_fallback.items():
+                result[k] = to_float(None if texts[f] is None else clean_text(texts[f]))
         # 保有目的は個別の提出者毎のようなのでこれだと複数とれてしまう
         #result["purpose"] = DataParserAbs.get_text(df, "jplvh_cor", "PurposeOfHolding")
         logger.info(f"Found: {result}")
@@ -22,22 +22,103 @@ edinet_api_fetch.py
 
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import SSLError, ConnectionError, ChunkedEncodingError, ReadTimeout
 import time
-from urllib.parse import urljoin
 from pathlib import Path
-from datetime import date
-from dateutil.relativedelta import relativedelta
+from datetime import date, timedelta
 import logging
 logger = logging.getLogger(__name__)
-import json
 import os
 import shutil
-import copy
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+import edinet_json
 
 class EdinetFetchError(RuntimeError):
     pass
 
+def _wait_all(futures):
+    # 全 future の結果を待つ
+    # 途中で例外が出たら未実行のものはキャンセルして再送出する
+    try:
+        return [f.result() for f in futures]
+    except BaseException:
+        for f in futures:
+            f.cancel()
+        raise
+
+@contextmanager
+def _replacing_dir(outdir):
+    # 一時ディレクトリを作って返し、with を正常に抜けたら outdir と置き換える
+    # 例外で抜けた場合は一時ディレクトリを消して outdir はそのまま残す
+    # NOTE: ディレクトリは上書きできないので既存の outdir は一旦退避してから消す
+    tmpdir = f"{outdir}.tmp-{os.getpid()}"
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    try:
+        yield Path(tmpdir)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    olddir = None
+    if os.path.exists(outdir):
+        olddir = f"{outdir}.old-{os.getpid()}"
+        if os.path.exists(olddir):
+            shutil.rmtree(olddir)
+        os.replace(outdir, olddir)
+    os.replace(tmpdir, outdir)
+    if olddir is not None:
+        shutil.rmtree(olddir)
+
+def _preallocate(f, size):
+    # 書き込み前にファイルの領域を確保しておく (断片化と書き込み毎のファイル拡張を避ける)
+    # 確保できない環境 (posix_fallocate がない, ファイルシステムが未対応) では何もしない
+    if size is None or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, int(size))
+    except (OSError, ValueError):
+        pass
+
+class _RateLimiter:
+    # token bucket によるリクエスト数の制限
+    # interval 秒毎に 1 つ token が貯まり (最大 burst 個)、リクエスト毎に 1 つ消費する
+    # token が足りない場合は予約して貯まるまで待つ (スレッド間で共有できる)
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+
+    def acquire(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) / self.interval)
+            self._last_refill = now
+            self._tokens -= 1
+            wait = -self._tokens * self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# Content-Type のメディアタイプ (パラメータ (charset 等) は除いて小文字で比較する)
+_CT_JSON = "application/json"
+_CT_OCTET = "application/octet-stream"
+_CT_PDF = "application/pdf"
+_CT_HTML = "text/html"
+
+def _media_type(h):
+    # レスポンスヘッダの Content-Type からメディアタイプだけを取り出す
+    # (cgi.parse_header は 3.13 で削除されたので自前で分ける)
+    return h.get("Content-Type", "").partition(";")[0].strip().lower()
+
 class EdinetAPIFetcher:
     # 取得 URL
     URL_API = "https://disclosure.edinet-fsa.go.jp/api/v1/"
@@ -50,32 +131,67 @@ class EdinetAPIFetcher:
     DOC_TYPE_ATTACH = 3
     DOC_TYPE_ENG = 4
     DOC_TYPE_LIST_FULL = [1, 2, 3, 4]
-
-    def __init__(self, *, fetch_interval=2, retry_interval=-1):
+    # 文書 type 毎の拡張子
+    _EXT_BY_DOC_TYPE = {DOC_TYPE_MAIN: "zip", DOC_TYPE_PDF: "pdf", DOC_TYPE_ATTACH: "zip", DOC_TYPE_ENG: "zip"}
+    # 文書 type と書類一覧でその存在を示す Flag の対応
+    # NOTE: xbrlFlag:"0" でも DOC_TYPE_MAIN は一応取得しておく。xbrl 以外もあるので
+    _FLAG_BY_DOC_TYPE = {DOC_TYPE_PDF: "pdfFlag", DOC_TYPE_ATTACH: "attachDocFlag", DOC_TYPE_ENG: "englishDocFlag"}
+    # この日数より前の書類一覧は確定しているものとして扱う
+    DOC_LIST_FIXED_DAYS = 2
+    # プロセス内で保持する書類一覧の数
+    DOC_LIST_MEMO_SIZE = 64
+    # 書類をファイルに書き出す際の読み込み単位 [byte]
+    CHUNK_SIZE = 64 * 1024
+    # リクエスト時の User-Agent
+    USER_AGENT = "edinet-api-tools"
+
+    def __init__(self, *, fetch_interval=2, fetch_burst=1, retry_interval=-1, max_retries=10, max_workers=1, day_workers=1, doc_list_cache_dir=None):
         # 取得間隔 [sec]
+        # リクエスト開始の間隔としてスレッド間で共有する
         self.fetch_interval = fetch_interval
+        # 間隔を空けずに続けてリクエストできる最大数
+        # (しばらくリクエストがなければこの数まで続けて投げられるが、平均の間隔は fetch_interval に保たれる)
+        self.fetch_burst = fetch_burst
         # 取得エラー時の retry 間隔 [sec]
         # 負数なら retry しない
         self.retry_interval = retry_interval
+        # 一回の取得あたりの最大 retry 回数
+        # None なら成功するまで retry する (障害が続くと終わらなくなるので注意)
+        self.max_retries = max_retries
+        # 書類取得の並列数
+        self.max_workers = max_workers
+        # save_period で日毎に並列に処理する数
+        # (書類の取得は全ての日で max_workers 並列を共有する。リクエストの開始間隔は変わらない)
+        self.day_workers = day_workers
+        self._rate_limiter = _RateLimiter(fetch_interval, fetch_burst)
+        # TCP/TLS 接続を使い回すための session (接続数は並列数に合わせる)
+        # NOTE: retry は EDINET のレスポンス内容を見て判断するので adapter 側ではしない
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_workers + day_workers)))
+        self._session.headers["User-Agent"] = EdinetAPIFetcher.USER_AGENT
+        # 書類一覧のキャッシュディレクトリ
+        # 指定があれば ETag/Last-Modified による条件付きリクエストで変更がない書類一覧の再取得を省く
+        self.doc_list_cache_dir = None if doc_list_cache_dir is None else Path(doc_list_cache_dir)
+        # 確定済みの書類一覧はプロセス内でも保持して同じ日の再取得を省く
+        self._doc_list_memo = {}
+        self._doc_list_memo_lock = threading.Lock()
+
+    def close(self):
+        # session の接続を閉じる
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @staticmethod
-    def _doc_ext(doc_type):
-        """ doc_type に対応する拡張子
-
-        Parameters
-        ----------
-        doc_type : int
-            取得する文書 type
-        Returns
-        -------
-        str
-        """
-        if doc_type == EdinetAPIFetcher.DOC_TYPE_PDF:
-            return "pdf"
-        else: # EdinetAPIFetcher.DOC_TYPE_MAIN, EdinetAPIFetcher.DOC_TYPE_ATTACH, EdinetAPIFetcher.DOC_TYPE_ENG
-            return "zip"
+    def _doc_outpath(base, doc_type):
+        # 文書の保存先パス (base は "{出力ディレクトリ}/{書類管理番号}")
+        return f"{base}_{doc_type}.{EdinetAPIFetcher._EXT_BY_DOC_TYPE.get(doc_type, 'zip')}"
 
-    def _fetch(self, url, params, headers):
+    def _fetch(self, url, params, headers, stream=False):
         """API データ取得用の基本関数
 
         Parameters
@@ -84,18 +200,20 @@ class EdinetAPIFetcher:
             データ取得先 URL
         params : dict
             取得用パラメータ
-        headers : dict
+        headers : dict or None
             取得用ヘッダ
+        stream : bool
+            True ならレスポンスボディをすぐには読み込まない
 
         Returns
         -------
         Response
         """
 
+        # 負荷をかけないようにリクエスト開始間隔を空ける
+        self._rate_limiter.acquire()
         # データ取得 (適当に timeout 時間を設定しておく)
-        r = requests.get(url, params=params, headers=headers, timeout=60)
-        # 終わったら負荷をかけないように一定時間休む
-        time.sleep(self.fetch_interval)
+        r = self._session.get(url, params=params, headers=headers, timeout=60, stream=stream)
         # status チェック (あまり意味ないかも)
         r.raise_for_status()
 
@@ -103,8 +221,8 @@ class EdinetAPIFetcher:
 
     def _fetcher_err_handling_common(self, r, ctype):
         # fetch 失敗時の共通処理
-        if ctype == "application/json;charset=utf-8":
-            meta = r.json()["metadata"]
+        if ctype == _CT_JSON:
+            meta = edinet_json.loads(r.content)["metadata"]
             status = int(meta["status"])
             msg = f"{meta['message']}({status})"
             if status == 400:
@@ -122,7 +240,7 @@ class EdinetAPIFetcher:
                     return {"handling" : "error", "message" : msg}
                 else:
                     return {"handling" : "retry", "message" : msg}
-        elif ctype == "text/html":
+        elif ctype == _CT_HTML:
             # sorry 画面っぽいやつが出る場合がある
             # retry 設定があれば retry
             msg = f"Invalid content type ({ctype})"
@@ -135,12 +253,45 @@ class EdinetAPIFetcher:
             msg = f"Unexpected content type ({ctype})!!"
             return {"handling" : "error", "message" : msg}
 
+    def _can_retry(self, n_retry):
+        # n_retry 回 retry した後にさらに retry できるか
+        if self.retry_interval < 0:
+            return False
+        return self.max_retries is None or n_retry < self.max_retries
+
     def _prepare_for_retry(self, msg):
         logger.warning(msg)
         logger.warning(f"Wait for retry ({self.retry_interval}sec) ...")
         time.sleep(self.retry_interval)
 
-    def fetch_doc_one(self, doc_id, doc_type):
+    def _load_cached_doc_list(self, day):
+        # キャッシュ済みの書類一覧とその検証用ヘッダを読む
+        # キャッシュがなければ None
+        if self.doc_list_cache_dir is None:
+            return None
+        list_path = self.doc_list_cache_dir / f"{day}.json.gz"
+        meta_path = self.doc_list_cache_dir / f"{day}.meta.json"
+        if not (list_path.exists() and meta_path.exists()):
+            return None
+        with gzip.open(list_path, "rb") as f:
+            j = edinet_json.loads(f.read())
+        with open(meta_path, "rb") as f:
+            meta = edinet_json.loads(f.read())
+        return j, meta
+
+    def _save_cached_doc_list(self, day, j, meta):
+        # 書類一覧と検証用ヘッダ (ETag, Last-Modified) を保存する
+        # 検証用ヘッダがなくても確定済みの日はキャッシュだけで返せるので保存しておく
+        if self.doc_list_cache_dir is None:
+            return
+        os.makedirs(self.doc_list_cache_dir, exist_ok=True)
+        list_path = self.doc_list_cache_dir / f"{day}.json.gz"
+        meta_path = self.doc_list_cache_dir / f"{day}.meta.json"
+        # meta は list より後に書くので meta があれば list は揃っている
+        edinet_json.write_bytes(list_path, gzip.compress(edinet_json.dumps(j), compresslevel=1))
+        edinet_json.write_bytes(meta_path, edinet_json.dumps(meta, indent=True))
+
+    def fetch_doc_one(self, doc_id, doc_type, stream=False, flags=None):
         """文書コード、type を指定して取得する関数
 
         Parameters
@@ -149,33 +300,55 @@ class EdinetAPIFetcher:
             取得する文書コード
         doc_type : int
             取得する文書 type
+        stream : bool
+            True ならボディを読み込まずに返す (呼び出し側で読み込んで close すること)
+        flags : dict
+            書類一覧の該当書類の項目 (pdfFlag 等)
+            指定すると Flag 的に存在しない文書 type はリクエストせずに None を返す
 
         Returns
         -------
-        dict or None(Not Found 時)
+        Response or None(Not Found 時)
             取得したデータ
         """
+        return self._fetch_doc_one(doc_id, doc_type, stream=stream, flags=flags)[0]
+
+    def _fetch_doc_one(self, doc_id, doc_type, stream=False, flags=None, n_retry=0):
+        # fetch_doc_one の実体
+        # n_retry はそれまでに retry した回数 (呼び出し側の retry と合わせて max_retries を超えないように)
+        # (Response or None, 取得までの retry 回数の合計) を返す
+        if flags is not None:
+            flag = EdinetAPIFetcher._FLAG_BY_DOC_TYPE.get(doc_type)
+            if flag is not None and flags.get(flag) == "0":
+                logger.info(f"document does not exist (doc_id: {doc_id}, type: {doc_type}, {flag}: 0). Skip...")
+                return None, n_retry
         params =  {"type" : doc_type}
-        headers = {}
+        headers = None
 
-        url = urljoin(EdinetAPIFetcher.URL_DOC, doc_id)
+        # URL_DOC は "/" で終わる固定の URL なので urljoin するまでもなく連結でよい
+        url = EdinetAPIFetcher.URL_DOC + doc_id
+        # 取得成功時の Content-Type
+        expected_ctype = _CT_PDF if doc_type == EdinetAPIFetcher.DOC_TYPE_PDF else _CT_OCTET
         err_msg_base = f"Failed to fetch a document!! (doc_id: {doc_id}, doc_type: {doc_type})"
         while True:
             logger.info(f"fetching document (doc_id: {doc_id}, type: {doc_type})...")
             try:
-                r = self._fetch(url, params, headers)
+                r = self._fetch(url, params, headers, stream=stream)
             except (SSLError, ConnectionError, ChunkedEncodingError, ReadTimeout) as e:
                 # たまにこれらのエラーが発生するのでその場合はリトライ
-                if self.retry_interval < 0:
+                if not self._can_retry(n_retry):
                     raise
                 self._prepare_for_retry(str(e))
+                n_retry += 1
                 continue
-            ctype = r.headers["Content-Type"].replace(" ", "")
-            if (doc_type == EdinetAPIFetcher.DOC_TYPE_PDF and ctype == "application/pdf") or (doc_type != EdinetAPIFetcher.DOC_TYPE_PDF and ctype == "application/octet-stream"):
+            ctype = _media_type(r.headers)
+            if ctype == expected_ctype:
                 # 取得成功
-                return r
+                return r, n_retry
             # 取得失敗時の処理
             e = self._fetcher_err_handling_common(r, ctype)
+            # stream 時は読み残しがあるかもしれないので接続を解放しておく
+            r.close()
             err_msg = err_msg_base + f": {e['message']}"
             if e["handling"] == "error":
                 raise EdinetFetchError(err_msg)
@@ -183,11 +356,49 @@ class EdinetAPIFetcher:
                 # warning を出してスルー
                 logger.warning(err_msg)
                 logger.warning("Skip...")
-                return None
+                return None, n_retry
             elif e["handling"] == "retry":
+                if not self._can_retry(n_retry):
+                    raise EdinetFetchError(err_msg + f" (gave up after {n_retry} retries)")
                 self._prepare_for_retry(err_msg)
+                n_retry += 1
                 continue
 
+    @staticmethod
+    def _is_saved(outpath):
+        # outpath が保存済みか (途中で落ちた場合は .part のまま残るので中身があれば保存済み)
+        try:
+            return os.stat(outpath).st_size > 0
+        except FileNotFoundError:
+            return False
+
+    def _save_doc_one(self, doc_id, doc_type, outpath, flags=None):
+        # 文書を取得して outpath に保存する
+        # 全体をメモリに載せないように少しずつ書き出す
+        # 書き終わるまでは .part に書いておき、最後に置き換える
+        part_path = f"{outpath}.part"
+        # retry 回数はリクエスト時と読み込み途中の分を合わせて数える
+        n_retry = 0
+        while True:
+            r, n_retry = self._fetch_doc_one(doc_id, doc_type, stream=True, flags=flags, n_retry=n_retry)
+            if r is None:
+                return
+            try:
+                with r, open(part_path, "wb") as f:
+                    _preallocate(f, r.headers.get("Content-Length"))
+                    for chunk in r.iter_content(chunk_size=EdinetAPIFetcher.CHUNK_SIZE):
+                        f.write(chunk)
+                    # 確保した領域が実際の長さより長い場合 (圧縮されていた場合等) は切り詰める
+                    f.truncate()
+                os.replace(part_path, outpath)
+                return
+            except (SSLError, ConnectionError, ChunkedEncodingError, ReadTimeout) as e:
+                # 読み込み途中で切れた場合もリトライ
+                if not self._can_retry(n_retry):
+                    raise
+                self._prepare_for_retry(str(e))
+                n_retry += 1
+
     def fetch_daily_doc_list(self, day, only_meta=False):
         """指定日の書類一覧を取得する関数
 
@@ -204,24 +415,74 @@ class EdinetAPIFetcher:
         dict or None(Not Found 時)
             取得したデータ
         """
+        r = self._fetch_daily_doc_list_with_validators(day, only_meta)
+        return None if r is None else r[0]
+
+    def _fetch_daily_doc_list_with_validators(self, day, only_meta=False, validators=None):
+        # 書類一覧とその検証用ヘッダ (ETag, Last-Modified) を取得する
+        # validators を指定すると呼び出し側が持っている書類一覧に対する条件付きリクエストにし、
+        # 変更がなければ書類一覧を None として返す
+        # 返り値は (書類一覧, 検証用ヘッダ) (Not Found 時は None)
+        key = (str(day), only_meta)
+        fixed = date.fromisoformat(str(day)) < date.today() - timedelta(days=EdinetAPIFetcher.DOC_LIST_FIXED_DAYS)
+        if fixed and validators is None:
+            with self._doc_list_memo_lock:
+                if key in self._doc_list_memo:
+                    return self._doc_list_memo[key]
+        r = self._fetch_daily_doc_list(day, only_meta, fixed, validators)
+        if fixed and r is not None and r[0] is not None:
+            with self._doc_list_memo_lock:
+                if len(self._doc_list_memo) >= EdinetAPIFetcher.DOC_LIST_MEMO_SIZE:
+                    # 古いものから捨てる
+                    del self._doc_list_memo[next(iter(self._doc_list_memo))]
+                self._doc_list_memo[key] = r
+        return r
+
+    def _fetch_daily_doc_list(self, day, only_meta, fixed, validators=None):
+        # _fetch_daily_doc_list_with_validators の実体 (API から取得する)
         target_type = 1 if only_meta else 2
 
         params =  {"date" : str(day), "type" : target_type}
         headers = {}
 
+        # キャッシュがあれば条件付きリクエストにする (メタデータのみの場合はキャッシュしない)
+        cached = None if only_meta else self._load_cached_doc_list(day)
+        if validators is not None:
+            # 呼び出し側の検証用ヘッダを使う (304 のときは呼び出し側の書類一覧をそのまま使ってもらう)
+            cached = (None, validators)
+        elif cached is not None:
+            if fixed:
+                # 確定済みの日はもう変わらないのでリクエストせずにキャッシュを返す
+                logger.info(f"using cached document list (date: {day})")
+                return cached
+            validators = cached[1]
+        if validators is not None:
+            if "ETag" in validators:
+                headers["If-None-Match"] = validators["ETag"]
+            if "Last-Modified" in validators:
+                headers["If-Modified-Since"] = validators["Last-Modified"]
+
         err_msg_base = f"Failed to fetch document list!! (day: {day})"
+        n_retry = 0
         while True:
             logger.info(f"fetching document list (date: {day}, type: {target_type})...")
             r = self._fetch(EdinetAPIFetcher.URL_DOC_LIST, params, headers)
-            ctype = r.headers["Content-Type"].replace(" ", "")
-            if ctype == "application/json;charset=utf-8":
-                j = r.json()
+            if r.status_code == 304 and cached is not None:
+                # 変更なしなのでキャッシュを返す
+                logger.info(f"document list is not modified (date: {day})")
+                return cached
+            ctype = _media_type(r.headers)
+            if ctype == _CT_JSON:
+                j = edinet_json.loads(r.content)
                 meta = j["metadata"]
                 status = int(meta["status"])
                 msg = meta["message"]
                 if status == 200:
                     # 取得成功
-                    return j
+                    validators = {k : r.headers[k] for k in ["ETag", "Last-Modified"] if k in r.headers}
+                    if not only_meta:
+                        self._save_cached_doc_list(day, j, validators)
+                    return j, validators
             # エラー時の処理
             e = self._fetcher_err_handling_common(r, ctype)
             err_msg = err_msg_base + f": {e['message']}"
@@ -233,12 +494,13 @@ class EdinetAPIFetcher:
                 logger.warning("Skip...")
                 return None
             elif e["handling"] == "retry":
-                logger.warning(err_msg)
-                logger.warning(f"Wait for retry ({self.retry_interval}sec) ...")
-                time.sleep(self.retry_interval)
+                if not self._can_retry(n_retry):
+                    raise EdinetFetchError(err_msg + f" (gave up after {n_retry} retries)")
+                self._prepare_for_retry(err_msg)
+                n_retry += 1
                 continue
 
-    def save_docs_for_id(self, outdir, doc_id, *, doc_types=None):
+    def save_docs_for_id(self, outdir, doc_id, *, doc_types=None, overwrite=False, flags=None):
         """指定文書コードのデータを保存
 
         Parameters
@@ -249,31 +511,40 @@ class EdinetAPIFetcher:
             出力ディレクトリパス
         doc_types : list
             取得する文書 type
+        overwrite : bool
+            True:  outdir を作り直して全て取得する
+            False: 保存済みのファイルは取得しない
+        flags : dict
+            書類一覧の該当書類の項目 (pdfFlag 等)
+            指定すると Flag 的に存在しない文書 type は取得しない
 
         Returns
         -------
         """
         outdir = Path(outdir)
-        if outdir.exists():
-            # outdir が存在してたら警告を出して消す
-            logger.warning(f"Removing existing output directory ({outdir}) ...")
-            shutil.rmtree(outdir)
-        os.makedirs(outdir)
+        if overwrite:
+            if outdir.exists():
+                # outdir が存在してたら警告を出して置き換える
+                logger.warning(f"Replacing existing output directory ({outdir}) ...")
+            # 一時ディレクトリに出力して、全部取得できたら outdir と置き換える
+            dir_ctx = _replacing_dir(outdir)
+        else:
+            os.makedirs(outdir, exist_ok=True)
+            dir_ctx = nullcontext(outdir)
 
         if doc_types is None:
             # デフォルトは main データだけ
             doc_types = [EdinetAPIFetcher.DOC_TYPE_MAIN]
 
-        for doc_type in doc_types:
-            ext = EdinetAPIFetcher._doc_ext(doc_type)
-            outpath = Path(f"{outdir / doc_id}_{doc_type}.{ext}")
-            r = self.fetch_doc_one(doc_id, doc_type)
-            if r is None:
-                continue
-            with open(outpath, "wb") as f:
-                f.write(r.content)
+        with dir_ctx as workdir:
+            base = os.path.join(workdir, doc_id)
+            for doc_type in doc_types:
+                outpath = EdinetAPIFetcher._doc_outpath(base, doc_type)
+                if not overwrite and EdinetAPIFetcher._is_saved(outpath):
+                    continue
+                self._save_doc_one(doc_id, doc_type, outpath, flags)
 
-    def save_daily(self, outdir, day, *, doc_types=None, doc_codes=None, need_sec_code=False, skip_if_list_exists=False, list_name="list.json"):
+    def save_daily(self, outdir, day, *, doc_types=None, doc_codes=None, need_sec_code=False, skip_if_list_exists=False, overwrite=False, list_name="list.json"):
         """指定日のデータを保存
 
         Parameters
@@ -290,51 +561,94 @@ class EdinetAPIFetcher:
             証券コードがない書類をスキップするか
         skip_if_list_exists : bool
             リストファイルが存在する場合その日をスキップするか
+        overwrite : bool
+            True:  outdir を作り直して全て取得する
+            False: 保存済みの書類ファイルは取得しない
         list_name : str
             リストファイル名
 
         Returns
         -------
         """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self._save_daily(executor, outdir, day, doc_types=doc_types, doc_codes=doc_codes, need_sec_code=need_sec_code, skip_if_list_exists=skip_if_list_exists, overwrite=overwrite, list_name=list_name)
+
+    def _save_daily(self, executor, outdir, day, *, doc_types=None, doc_codes=None, need_sec_code=False, skip_if_list_exists=False, overwrite=False, list_name="list.json"):
+        # save_daily の実体
+        # 書類の取得は executor に投げる (save_period では全ての日で共有する)
+        flag_by_type = EdinetAPIFetcher._FLAG_BY_DOC_TYPE
         def valid_doc_types(doc_types, d):
             # Flag 的に存在しない文書 type はスキップ
-            result = copy.deepcopy(doc_types)
-            # NOTE: xbrlFlag:"0" でも DOC_TYPE_MAIN は一応取得しておく。xbrl 以外もあるので
-            flag_dict = {"pdfFlag": EdinetAPIFetcher.DOC_TYPE_PDF, "attachDocFlag": EdinetAPIFetcher.DOC_TYPE_ATTACH, "englishDocFlag": EdinetAPIFetcher.DOC_TYPE_ENG}
-            for k, v in flag_dict.items(): 
-                if v in result and d[k] == "0":
-                    result.remove(v)
-            return result
+            return [t for t in doc_types if t not in flag_by_type or d[flag_by_type[t]] != "0"]
 
+        if doc_types is None:
+            # デフォルトは main データだけ
+            doc_types = [EdinetAPIFetcher.DOC_TYPE_MAIN]
         outdir = Path(outdir)
         list_path = outdir / list_name
+        # list の検証用ヘッダ (ETag, Last-Modified) の保存先 (list.json -> list.meta.json)
+        list_meta_path = list_path.with_suffix(".meta.json")
         if skip_if_list_exists and list_path.exists():
             # skip_if_list_exists=True で list があったらスキップ
             logger.warning(f"Skipped: '{list_path}' already exists.")
             return
-        if outdir.exists():
-            # outdir が存在してたら消す
-            shutil.rmtree(outdir)
-        os.makedirs(outdir)
 
-        j = api.fetch_daily_doc_list(day)
-        if j is None:
+        # 前回出力した list の検証用ヘッダがあれば条件付きリクエストにする
+        # (overwrite の場合は変更がなくても取得し直すので条件付きにしない)
+        validators = None
+        if not overwrite and list_path.exists() and list_meta_path.exists():
+            with open(list_meta_path, "rb") as f:
+                validators = edinet_json.loads(f.read()) or None
+        r = self._fetch_daily_doc_list_with_validators(day, validators=validators)
+        if r is not None and r[0] is None:
+            # 前回から変更がないのでスキップ
+            logger.info(f"Skipped: '{list_path}' is up to date.")
             return
-        for d in j["results"]:
-            if doc_codes is not None and not d["docTypeCode"] in doc_codes:
-                continue
-            if need_sec_code and d["secCode"] is None:
-                continue
-            doc_id = d["docID"]
-            outdir_id = outdir / doc_id
-            self.save_docs_for_id(outdir_id, doc_id, doc_types=valid_doc_types(doc_types, d))
-
-        # 全部取得したら最後に list を出力
-        # 最後に出力することでこれがあるかどうかで一通り全部取得できたチェックにも使えるように
-        with open(list_path, "w") as f:
-            json.dump(j, f, indent=2, ensure_ascii=False)
+        if r is None:
+            # 書類一覧が取得できなかった場合は前回の出力をそのまま残す
+            return
+        j, validators = r
 
-    def save_period(self, outdir, start_day, end_day, *, doc_types=None, doc_codes=None, need_sec_code=False, skip_if_list_exists=True):
+        if overwrite:
+            # 一時ディレクトリに出力して、全部取得できたら outdir と置き換える
+            # (途中で失敗しても前回の出力は残る)
+            dir_ctx = _replacing_dir(outdir)
+        else:
+            # 保存済みの書類ファイルはそのまま使う (途中で落ちた日の続きから取得できる)
+            os.makedirs(outdir, exist_ok=True)
+            dir_ctx = nullcontext(outdir)
+        with dir_ctx as workdir:
+            # 書類と文書 type の組毎に executor で並列に取得する
+            # (1 書類の複数 type も並列に取得できるように書類単位ではなく文書単位で投げる)
+            futures = []
+            for d in j["results"]:
+                if doc_codes is not None and not d["docTypeCode"] in doc_codes:
+                    continue
+                if need_sec_code and d["secCode"] is None:
+                    continue
+                doc_id = d["docID"]
+                outdir_id = os.path.join(workdir, doc_id)
+                # overwrite の場合 workdir は作ったばかりなので書類毎のディレクトリは存在しない
+                if overwrite or not os.path.isdir(outdir_id):
+                    os.mkdir(outdir_id)
+                base = os.path.join(outdir_id, doc_id)
+                for doc_type in valid_doc_types(doc_types, d):
+                    outpath = EdinetAPIFetcher._doc_outpath(base, doc_type)
+                    if not overwrite and EdinetAPIFetcher._is_saved(outpath):
+                        continue
+                    futures.append(executor.submit(self._save_doc_one, doc_id, doc_type, outpath))
+            _wait_all(futures)
+
+            # 全部取得したら最後に list を出力
+            # 最後に出力することでこれがあるかどうかで一通り全部取得できたチェックにも使えるように
+            with open(workdir / list_name, "wb") as f:
+                f.write(edinet_json.dumps(j, indent=True))
+            # 検証用ヘッダは list の後に出力 (これがあれば list は揃っている)
+            if validators:
+                with open(workdir / list_meta_path.name, "wb") as f:
+                    f.write(edinet_json.dumps(validators, indent=True))
+
+    def save_period(self, outdir, start_day, end_day, *, doc_types=None, doc_codes=None, need_sec_code=False, skip_if_list_exists=True, overwrite=False):
         """指定期間のデータを保存
 
         Parameters
@@ -353,6 +667,9 @@ class EdinetAPIFetcher:
             証券コードがない書類をスキップするか
         skip_if_list_exists : bool
             リストファイルが存在する場合その日をスキップするか
+        overwrite : bool
+            True:  各日の出力ディレクトリを作り直して全て取得する
+            False: 保存済みの書類ファイルは取得しない
 
         Returns
         -------
@@ -362,11 +679,15 @@ class EdinetAPIFetcher:
             start_day = date.fromisoformat(start_day)
         if isinstance(end_day, str):
             end_day = date.fromisoformat(end_day)
-        day = start_day
-        while day <= end_day:
-            daydir = Path(outdir) / str(day)
-            self.save_daily(daydir, day, doc_types=doc_types, doc_codes=doc_codes, need_sec_code=need_sec_code, skip_if_list_exists=skip_if_list_exists)
-            day += relativedelta(days=1)
+        days = [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
+        # 日毎の処理 (書類一覧の取得) は day_workers 並列で行い、書類の取得は全ての日で共有する max_workers 並列の pool に投げる
+        # (ある日の書類を取得している間に次の日の書類一覧を取得して pool が空かないようにする)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as doc_executor, ThreadPoolExecutor(max_workers=self.day_workers) as executor:
+            futures = []
+            for day in days:
+                daydir = outdir / str(day)
+                futures.append(executor.submit(self._save_daily, doc_executor, daydir, day, doc_types=doc_types, doc_codes=doc_codes, need_sec_code=need_sec_code, skip_if_list_exists=skip_if_list_exists, overwrite=overwrite))
+            _wait_all(futures)
 
 
 # 直接実行時
@@ -378,6 +699,11 @@ if __name__ == "__main__":
     parser.add_argument("--full", help="fetch full data", action="store_true", default=False)
     parser.add_argument("--doc-code", metavar="NNN", help="fetch documents with specific document code", nargs="*", dest="doc_codes")
     parser.add_argument("--need-sec-code", help="skip documents without sec code", action="store_true", default=False)
+    parser.add_argument("--overwrite", help="overwrite existing data", action="store_true", default=False)
+    parser.add_argument("--update", help="re-check days already fetched and fetch only updated lists and missing documents", action="store_true", default=False)
+    parser.add_argument("--workers", metavar="N", help="number of documents fetched in parallel", type=int, default=1)
+    parser.add_argument("--day-workers", metavar="N", help="number of days whose document lists are processed in parallel", type=int, default=1)
+    parser.add_argument("--max-retries", metavar="N", help="max number of retries per request", type=int, default=10)
     args = parser.parse_args()
     logging.basicConfig(
         level = logging.INFO,
@@ -390,5 +716,5 @@ if __name__ == "__main__":
         doc_types = EdinetAPIFetcher.DOC_TYPE_LIST_FULL
     else:
         doc_types = [EdinetAPIFetcher.DOC_TYPE_MAIN]
-    api = EdinetAPIFetcher(retry_interval=60)
-    api.save_period(args.dir, start_day, end_day, doc_types=doc_types, doc_codes=args.doc_codes, need_sec_code=args.need_sec_code)
+    with EdinetAPIFetcher(retry_interval=60, max_retries=args.max_retries, max_workers=args.workers, day_workers=args.day_workers) as api:
+        api.save_period(args.dir, start_day, end_day, doc_types=doc_types, doc_codes=args.doc_codes, need_sec_code=args.need_sec_code, skip_if_list_exists=not (args.overwrite or args.update), overwrite=args.overwrite)
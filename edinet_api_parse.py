@@ -19,21 +19,23 @@ edinet_api_parse.py
 - script to parse data fetched via EDINET API
 """
 
+import pandas as pd
 from pathlib import Path
-from datetime import date
-from dateutil.relativedelta import relativedelta
+from datetime import date, timedelta
 import logging
 logger = logging.getLogger(__name__)
-import json
 from abc import ABCMeta, abstractmethod
 import copy
-import glob
+from functools import lru_cache
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import os
 import re
 import shutil
 
 import xbrl_edinet
 from xbrl_edinet import XbrlEdinetParseError
+import edinet_json
 
 class EdinetApiParseError(RuntimeError):
     pass
@@ -41,6 +43,54 @@ class EdinetApiParseError(RuntimeError):
 class EdinetApiParseUnexpectedError(RuntimeError):
     pass
 
+@lru_cache(maxsize=32)
+def _ns_pre_matcher(ns_pre):
+    # ns_pre (正規表現) に先頭から match するかを判定する関数
+    # 正規表現の特殊文字を含まない場合 (jppfs_cor 等) は前方一致と同じなので startswith で判定する
+    if re.escape(ns_pre) == ns_pre:
+        return lambda n: n.startswith(ns_pre)
+    return re.compile(ns_pre).match
+
+# DataFrame の検索用索引
+class DataIndex:
+    """xbrl_edinet.parse_zip() の DataFrame を tag 毎にまとめた索引
+
+    DataParserAbs.get_row() 等に DataFrame の代わりに渡すと、
+    検索毎に全行を走査せずに tag の一致する行だけを見る
+    """
+    def __init__(self, df):
+        self.df = df
+        # {tag : [(ns_pre, context_id, 行番号), ...]}
+        self._rows = {}
+        for i, (ns_pre, tag, context_id) in enumerate(zip(df["ns_pre"], df["tag"], df["context_id"])):
+            self._rows.setdefault(tag, []).append((ns_pre, context_id, i))
+        # text は行 (Series) を作らずに直接取り出せるようにしておく
+        # (pandas のバージョンによっては値のない要素が NaN になるので None に揃える)
+        self._texts = [None if pd.isna(t) else t for t in df["text"]]
+
+    def find(self, ns_pre, tag, context_id=None):
+        # 条件に合う行番号のリスト (ns_pre は正規表現として match する)
+        match = None if ns_pre is None else _ns_pre_matcher(ns_pre)
+        return [i for n, c, i in self._rows.get(tag, ())
+                if (context_id is None or c == context_id) and (match is None or match(n))]
+
+    def text(self, ns_pre, tag, context_id=None):
+        # 条件に合う行の text (行がなければ None, 複数あればエラー)
+        rows = self.find(ns_pre, tag, context_id)
+        if len(rows) < 1:
+            return None
+        elif len(rows) == 1:
+            return self._texts[rows[0]]
+        else:
+            raise EdinetApiParseUnexpectedError(f"Multiple rows exist! (condition: {_condition_str(tag, context_id)})")
+
+def _condition_str(tag, context_id=None):
+    # 検索条件の表示用文字列
+    cond = f"(tag == '{tag}')"
+    if context_id is not None:
+        cond += f" & (context_id == '{context_id}')"
+    return cond
+
 # データ parser 基底クラス
 class DataParserAbs(metaclass=ABCMeta):
     @abstractmethod
@@ -56,13 +106,18 @@ class DataParserAbs(metaclass=ABCMeta):
     @staticmethod
     def get_row(df, ns_pre, tag, context_id=None, multi=False):
         # 行を抜き出す
-        if ns_pre is not None:
-            # ns_pre は正規表現として match する
-            df = df[df["ns_pre"].str.match(ns_pre)]
-        cond = f"(tag == '{tag}')"
-        if context_id is not None:
-            cond += f" & (context_id == '{context_id}')"
-        r = df.query(cond)
+        # df は DataFrame か DataIndex (同じ df から何度も抜き出す場合は DataIndex の方が速い)
+        cond = _condition_str(tag, context_id)
+        if isinstance(df, DataIndex):
+            r = df.df.iloc[df.find(ns_pre, tag, context_id)]
+        else:
+            if ns_pre is not None:
+                # ns_pre は正規表現として match する (特殊文字を含まなければ前方一致で済ませる)
+                if re.escape(ns_pre) == ns_pre:
+                    df = df[df["ns_pre"].str.startswith(ns_pre)]
+                else:
+                    df = df[df["ns_pre"].str.match(re.compile(ns_pre))]
+            r = df.query(cond)
 
         if multi:
             return r
@@ -73,29 +128,41 @@ class DataParserAbs(metaclass=ABCMeta):
         else:
             raise EdinetApiParseUnexpectedError(f"Multiple rows exist! (condition: {cond})")
 
+    # clean_text で除く HTML タグ
+    _SPAN_TAG_RE = re.compile("</?span[^>]*?>")
+    _P_TAG_RE = re.compile("</?p[^>]*?>")
+
     @staticmethod
-    def get_text(df, ns_pre, tag, context_id=None, remove_tag=False):
-        r = DataParserAbs.get_row(df, ns_pre, tag, context_id)
-        if r is None or r["text"] is None:
-            return None
-        s = r["text"].replace("\n", "").replace("\u3000", "  ").replace("\xa0", " ")
+    def clean_text(s, remove_tag=False):
+        # 改行や全角スペース等を置換する
+        # NOTE: str.translate で一度に置換するより replace を重ねる方が速い (置換対象がない文字列も多いので)
+        s = s.replace("\n", "").replace("\u3000", "  ").replace("\xa0", " ")
         if remove_tag:
-            s = re.sub("</?span[^>]*?>", "", s)
-            s = re.sub("</?p[^>]*?>", "", s)
+            s = DataParserAbs._SPAN_TAG_RE.sub("", s)
+            s = DataParserAbs._P_TAG_RE.sub("", s)
         return s
 
+    @staticmethod
+    def get_text(df, ns_pre, tag, context_id=None, remove_tag=False):
+        if isinstance(df, DataIndex):
+            # 索引からは行を作らずに text だけ取り出す
+            t = df.text(ns_pre, tag, context_id)
+        else:
+            r = DataParserAbs.get_row(df, ns_pre, tag, context_id)
+            t = None if r is None or pd.isna(r["text"]) else r["text"]
+        if t is None:
+            return None
+        return DataParserAbs.clean_text(t, remove_tag)
+
     @staticmethod
     def get_text_multi(df, ns_pre, tag, context_id=None, remove_tag=False):
         r = DataParserAbs.get_row(df, ns_pre, tag, context_id, True)
         texts = []
         for t in r["text"]:
-            if t is None:
+            if pd.isna(t):
                 texts.append(None)
                 continue
-            tt = t.replace("\n", "").replace("\u3000", "  ").replace("\xa0", " ")
-            tt = re.sub("</?span[^>]*?>", "", tt)
-            tt = re.sub("</?p[^>]*?>", "", tt)
-            texts.append(tt)
+            texts.append(DataParserAbs.clean_text(t, True))
         return texts
 
     @staticmethod
@@ -131,26 +198,39 @@ class EdinetApiDocParserAbs(metaclass=ABCMeta):
 
     def save_pdf(self, id_dir):
         # debug 指定があれば pdf を指定ディレクトリにコピーする
-        pdf_pattern = str(id_dir / "*_2.pdf")
-        pdf_path = glob.glob(pdf_pattern)
-        if len(pdf_path) > 0:
-            pdf_path = Path(pdf_path[0])
+        pdf_path = next(Path(id_dir).glob("*_2.pdf"), None)
+        if pdf_path is not None:
             shutil.copyfile(pdf_path, self.debug_pdf_dir / pdf_path.name)
 
+# worker プロセス毎の doc_parser (Pool の initializer で一度だけ設定する)
+_worker_doc_parser = None
+
+def _init_worker(doc_parser):
+    global _worker_doc_parser
+    _worker_doc_parser = doc_parser
+
+def _parse_target_safe(id_dir):
+    """multi processing 実行用
+    """
+    try:
+        return _worker_doc_parser.parse_id_dir(id_dir)
+    except (EdinetApiParseError, XbrlEdinetParseError) as e:
+        logger.warning(e)
+        logger.warning(f"Skip {id_dir}...")
+        return None
+
 class EdinetApiParser:
     def __init__(self, doc_parser, *, cpu_count=None):
         self.doc_parser = doc_parser
         self.cpu_count = cpu_count
 
-    def _parse_target_safe(self, id_dir):
-        """multi processing 実行用
-        """
-        try:
-            return self.doc_parser.parse_id_dir(id_dir)
-        except (EdinetApiParseError, XbrlEdinetParseError) as e:
-            logger.warning(e)
-            logger.warning(f"Skip {id_dir}...")
+    @staticmethod
+    def _load_doc_list(doc_list_path):
+        # doc_list.json を読む (存在しなければ None)
+        if not doc_list_path.exists():
             return None
+        with open(doc_list_path, "rb") as f:
+            return edinet_json.loads(f.read())
 
     def parse(self, data_dir, start_day, end_day):
         """データをパースして pandas.DataFrame にして返す関数
@@ -167,32 +247,35 @@ class EdinetApiParser:
         # 取得対象全データを格納
         id_dirs = []
         info_list = []
-        day = start_day
-        while day <= end_day:
-            logger.debug(f"{day} START")
-            day_dir = data_dir / str(day)
-            doc_list_path = day_dir / "doc_list.json"
-            if doc_list_path.exists():
-                with open(doc_list_path, "r") as f:
-                    doc_list = json.load(f)
-                info_list_day = self.doc_parser.get_targets_from_doclist(doc_list)
-                for info in info_list_day:
-                    id_ = info["doc_id"]
-                    id_dir = day_dir / id_
-                    if id_dir.exists():
-                        info_list.append(info)
-                        id_dirs.append(id_dir)
-                    else:
-                        logger.warning(f"Document does not exist!")
-                        logger.warning(f"Skip {id_dir}...")
-            else:
-                logger.warning(f"Document list does not exist ({doc_list_path}). Skip...")
-            day += relativedelta(days=1)
+        days = [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
+        # 各日の doc_list.json は先にスレッドで読み込んでおく (読み込みと抽出を重ねる)
+        doc_list_paths = [data_dir / str(day) / "doc_list.json" for day in days]
+        with ThreadPoolExecutor() as executor:
+            doc_lists = executor.map(EdinetApiParser._load_doc_list, doc_list_paths)
+            for day, doc_list_path, doc_list in zip(days, doc_list_paths, doc_lists):
+                logger.debug(f"{day} START")
+                day_dir = doc_list_path.parent
+                if doc_list is not None:
+                    info_list_day = self.doc_parser.get_targets_from_doclist(doc_list)
+                    for info in info_list_day:
+                        id_ = info["doc_id"]
+                        id_dir = day_dir / id_
+                        if id_dir.exists():
+                            info_list.append(info)
+                            id_dirs.append(id_dir)
+                        else:
+                            logger.warning(f"Document does not exist!")
+                            logger.warning(f"Skip {id_dir}...")
+                else:
+                    logger.warning(f"Document list does not exist ({doc_list_path}). Skip...")
         # multi process で実行
-        data_list = Pool(self.cpu_count).map(self._parse_target_safe, id_dirs)
-
+        # doc_parser は initializer で worker 毎に一度だけ渡し、タスク毎には id_dir だけ送る
+        # IPC の回数を減らすためにプロセス毎にある程度まとめて渡す
+        n_procs = self.cpu_count or os.cpu_count() or 1
+        chunksize = max(1, len(id_dirs) // (n_procs * 4))
         results = []
-        for i, d in zip(info_list, data_list):
-            results.append({"info" : i, "data" : d})
+        with Pool(self.cpu_count, initializer=_init_worker, initargs=(self.doc_parser,)) as pool:
+            for i, d in zip(info_list, pool.imap(_parse_target_safe, id_dirs, chunksize=chunksize)):
+                results.append({"info" : i, "data" : d})
 
         return results
@@ -20,76 +20,78 @@ edinet_api_parse_sec_report.py
 """
 
 import pandas as pd
-import datetime
 import logging
+import hashlib
+import operator
+import os
+import pickle
 logger = logging.getLogger(__name__)
 
 import xbrl_edinet
+import edinet_json
 from edinet_api_parse import *
 
 # 有価証券報告書財務データの basic な parser
 class BasicFinancialDataParser(DataParserAbs):
+    # 取得する値 (結果のキー, jppfs_cor の tag, True: 時点 (Instant) / False: 期間 (Duration))
+    _ITEMS = [
+        # BS 関連
+        ("assets", "Assets", True), # 資産
+        ("current_assets", "CurrentAssets", True), # 流動資産
+        ("noncurrent_assets", "NoncurrentAssets", True), # 固定資産
+        ("liabilities", "Liabilities", True), # 負債
+        ("current_liabilities", "CurrentLiabilities", True), # 流動負債
+        ("noncurrent_liabilities", "NoncurrentLiabilities", True), # 固定負債
+        ("net_assets", "NetAssets", True), # 純資産
+        ("liabilities_and_net_assets", "LiabilitiesAndNetAssets", True), # 負債純資産
+        # PL 関連
+        ("net_sales", "NetSales", False), # 売上高
+        ("operating_income", "OperatingIncome", False), # 営業利益
+        ("ordinary_income", "OrdinaryIncome", False), # 経常利益
+        ("profit_loss", "ProfitLoss", False), # 純利益
+        # CF 関連
+        ("operating_cashflow", "NetCashProvidedByUsedInOperatingActivities", False), # 営業キャッシュフロー
+        ("investment_cashflow", "NetCashProvidedByUsedInInvestmentActivities", False), # 投資キャッシュフロー
+        ("financing_cashflow", "NetCashProvidedByUsedInFinancingActivities", False), # 財務キャッシュフロー
+    ]
+
     def __init__(self):
         pass
 
     @staticmethod
-    def get_jppfs_current_ins(df, id_, as_float=False):
+    def _get_current(df, ns_pre, id_, context_id, as_float=False):
         func = DataParserAbs.get_float if as_float else DataParserAbs.get_int
-        r = func(df, "jppfs_cor", id_, "CurrentYearInstant")
+        r = func(df, ns_pre, id_, context_id)
         if r is None:
             # 連結のがなかったら(重要性が乏しい場合は作成されない？)、非連結の値を取得する
-            r = func(df, "jppfs_cor", id_, "CurrentYearInstant_NonConsolidatedMember")
+            r = func(df, ns_pre, id_, f"{context_id}_NonConsolidatedMember")
         return r
 
+    @staticmethod
+    def get_jppfs_current_ins(df, id_, as_float=False):
+        return BasicFinancialDataParser._get_current(df, "jppfs_cor", id_, "CurrentYearInstant", as_float)
+
     @staticmethod
     def get_jppfs_current_dur(df, id_, as_float=False):
-        func = DataParserAbs.get_float if as_float else DataParserAbs.get_int
-        r = func(df, "jppfs_cor", id_, "CurrentYearDuration")
-        if r is None:
-            # 連結のがなかったら(重要性が乏しい場合は作成されない？)、非連結の値を取得する
-            r = func(df, "jppfs_cor", id_, "CurrentYearDuration_NonConsolidatedMember")
-        return r
+        return BasicFinancialDataParser._get_current(df, "jppfs_cor", id_, "CurrentYearDuration", as_float)
 
     @staticmethod
     def get_jpcrp_current_ins(df, id_, as_float=False):
-        func = DataParserAbs.get_float if as_float else DataParserAbs.get_int
         # 連結の場合もある？
-        r = func(df, "jpcrp_cor", id_, "CurrentYearInstant")
-        if r is None:
-            r = func(df, "jpcrp_cor", id_, "CurrentYearInstant_NonConsolidatedMember")
-        return r
+        return BasicFinancialDataParser._get_current(df, "jpcrp_cor", id_, "CurrentYearInstant", as_float)
 
     @staticmethod
     def get_jpcrp_current_dur(df, id_, as_float=False):
-        func = DataParserAbs.get_float if as_float else DataParserAbs.get_int
         # 連結の場合もある？
-        r = func(df, "jpcrp_cor", id_, "CurrentYearDuration")
-        if r is None:
-            r = func(df, "jpcrp_cor", id_, "CurrentYearDuration_NonConsolidatedMember")
-        return r
+        return BasicFinancialDataParser._get_current(df, "jpcrp_cor", id_, "CurrentYearDuration", as_float)
 
     def parse(self, df):
+        # 同じ df から何度も値を取り出すので先に索引を作っておく
+        df = DataIndex(df)
         d = {}
-        # BS 関連
-        d["assets"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "Assets") # 資産
-        d["current_assets"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "CurrentAssets") # 流動資産
-        d["noncurrent_assets"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "NoncurrentAssets") # 固定資産
-        d["liabilities"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "Liabilities") # 負債
-        d["current_liabilities"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "CurrentLiabilities") # 流動負債
-        d["noncurrent_liabilities"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "NoncurrentLiabilities") # 固定負債
-        d["net_assets"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "NetAssets") # 純資産
-        d["liabilities_and_net_assets"] = BasicFinancialDataParser.get_jppfs_current_ins(df, "LiabilitiesAndNetAssets") # 負債純資産
-
-        # PL 関連
-        d["net_sales"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "NetSales") # 売上高
-        d["operating_income"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "OperatingIncome") # 営業利益
-        d["ordinary_income"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "OrdinaryIncome") # 経常利益
-        d["profit_loss"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "ProfitLoss") # 純利益
-
-        # CF 関連
-        d["operating_cashflow"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "NetCashProvidedByUsedInOperatingActivities") # 営業キャッシュフロー
-        d["investment_cashflow"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "NetCashProvidedByUsedInInvestmentActivities") # 投資キャッシュフロー
-        d["financing_cashflow"] = BasicFinancialDataParser.get_jppfs_current_dur(df, "NetCashProvidedByUsedInFinancingActivities") # 財務キャッシュフロー
+        get_current = BasicFinancialDataParser._get_current
+        for key, tag, instant in BasicFinancialDataParser._ITEMS:
+            d[key] = get_current(df, "jppfs_cor", tag, "CurrentYearInstant" if instant else "CurrentYearDuration")
         # フリーキャッシュフロー
         if d["operating_cashflow"] is not None and d["investment_cashflow"] is not None:
             d["free_cashflow"] = d["operating_cashflow"] + d["investment_cashflow"]
@@ -100,16 +102,28 @@ class BasicFinancialDataParser(DataParserAbs):
 
 # 有価証券報告書 parser
 class EdinetApiSecReportParser(EdinetApiDocParserAbs):
-    def __init__(self, data_parser, *, debug_config={}):
+    def __init__(self, data_parser, *, debug_config={}, cache_dir=None):
         super().__init__(data_parser, debug_config=debug_config)
+        # 指定があったら zip 毎のパース結果をキャッシュする (zip の更新日時, サイズが変わらなければ再利用)
+        # data_parser の処理内容を変えた場合はキャッシュを消すこと
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
         # 指定があったら debug 用の csv を出力する
         self.debug_csv_dir = Path(debug_config["csv_dir"]) if "csv_dir" in debug_config else None
         # 指定があったら対象証券コードのみ処理
-        self.debug_sec_codes = debug_config["sec_codes"] if "sec_codes" in debug_config else None
+        self.debug_sec_codes = frozenset(debug_config["sec_codes"]) if "sec_codes" in debug_config else None
+
+    # doc_list から使いそうな項目 {doc_list のキー : 結果のキー}
+    _INFO_KEYS = {"docID" : "doc_id", "secCode" : "sec_code", "filerName" : "name", "periodStart" : "start_date", "periodEnd" : "end_date"}
+    # doc_list の値をまとめて tuple で取り出す getter と結果のキー
+    _INFO_GETTER = operator.itemgetter(*_INFO_KEYS)
+    _INFO_OUT_KEYS = tuple(_INFO_KEYS.values())
 
     # doc_list からデータを取得する対象を抽出
     def get_targets_from_doclist(self, doc_list):
         target_info_list = []
+        info_getter = EdinetApiSecReportParser._INFO_GETTER
+        out_keys = EdinetApiSecReportParser._INFO_OUT_KEYS
+        sec_codes = self.debug_sec_codes
         for d in doc_list["results"]:
             # 書類種別コードが 120 以外、または提出者証券コードが空なものは Skip
             if d["docTypeCode"] != "120" or d["secCode"] is None:
@@ -119,22 +133,20 @@ class EdinetApiSecReportParser(EdinetApiDocParserAbs):
                 logger.warning(f"Skip document (ordinanceCode:{d['ordinanceCode']}, formCode:{d['formCode']}): {d} ...")
                 continue
             # 対象証券コード以外は Skip
-            if self.debug_sec_codes is not None and d["secCode"] not in self.debug_sec_codes:
+            if sec_codes is not None and d["secCode"] not in sec_codes:
                 continue
             # doc_list から使いそうな項目のみ選択
-            keys = {"docID" : "doc_id", "secCode" : "sec_code", "filerName" : "name", "periodStart" : "start_date", "periodEnd" : "end_date"}
-            info = {v : d[k] for k, v in keys.items()}
-            info["submit_date"] = str(datetime.datetime.fromisoformat(d["submitDateTime"]).date())
+            info = dict(zip(out_keys, info_getter(d)))
+            # 提出日時 ("YYYY-MM-DD hh:mm") の日付部分 (datetime に変換するまでもない)
+            info["submit_date"] = d["submitDateTime"][:10]
             target_info_list.append(info)
         return target_info_list
 
     # 一つの EDINET ID directory に対する parse
     def parse_id_dir(self, id_dir):
-        zip_pattern = str(id_dir / "*_1.zip")
-        zip_path = glob.glob(zip_pattern)
-        if len(zip_path) < 1:
-            raise EdinetApiParseError(f"No such file ({zip_pattern})")
-        zip_path = Path(zip_path[0])
+        zip_path = next(Path(id_dir).glob("*_1.zip"), None)
+        if zip_path is None:
+            raise EdinetApiParseError(f"No such file ({id_dir / '*_1.zip'})")
         r = self.parse_zip(zip_path)
 
         if self.debug_pdf_dir is not None:
@@ -142,16 +154,32 @@ class EdinetApiSecReportParser(EdinetApiDocParserAbs):
 
         return r
 
+    def _cache_path(self, zip_path):
+        st = zip_path.stat()
+        key = f"{zip_path.resolve()}:{st.st_mtime_ns}:{st.st_size}:{type(self.data_parser).__name__}"
+        return self.cache_dir / f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.pickle"
+
     def parse_zip(self, zip_path):
+        # debug 用の csv を出力する場合は毎回パースする
+        cache_path = None
+        if self.cache_dir is not None and self.debug_csv_dir is None:
+            cache_path = self._cache_path(zip_path)
+            if cache_path.exists():
+                logger.debug(f"use cache for {zip_path}")
+                with open(cache_path, "rb") as f:
+                    return pickle.load(f)
         logger.info(f"parse {zip_path} ...")
         # データを取得してパース
         df = xbrl_edinet.parse_zip(zip_path)
         if df is not None and self.debug_csv_dir is not None:
-            with open(self.debug_csv_dir / f"{zip_path.parent.name}.csv", mode="w", encoding="cp932", errors="ignore") as f:
-                df.to_csv(f, index=False)
-
+            # パスを直接渡して pandas 側でファイルを開いて書かせる
+            df.to_csv(self.debug_csv_dir / f"{zip_path.parent.name}.csv", index=False, encoding="cp932", errors="ignore")
 
-        return self.data_parser.parse(df)
+        d = self.data_parser.parse(df)
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            edinet_json.write_bytes(cache_path, pickle.dumps(d))
+        return d
 
 # テストコード
 if __name__ == "__main__":
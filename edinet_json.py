@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Copyright 2023 Sarubee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+edinet_json.py
+- JSON helpers (use orjson if available)
+"""
+
+import json
+import os
+try:
+    import orjson
+except ImportError:
+    # orjson がなければ標準ライブラリの json を使う
+    orjson = None
+
+def loads(s):
+    """JSON 文字列 (bytes or str) を読む
+
+    Parameters
+    ----------
+    s : bytes or str
+        JSON 文字列
+
+    Returns
+    -------
+    object
+    """
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+def dumps(obj, *, indent=False):
+    """obj を JSON (UTF-8 の bytes) にする
+
+    Parameters
+    ----------
+    obj : object
+        出力するオブジェクト
+    indent : bool
+        True なら 2 スペースでインデントする
+
+    Returns
+    -------
+    bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode("utf-8")
+
+def write_bytes(path, data):
+    """data を path に書き込む
+
+    途中で落ちても壊れたファイルが残らないように、一時ファイルに書いてから置き換える
+    (一時ファイル名にはプロセス ID を入れるので複数プロセスから同じ path に書いてもよい)
+
+    Parameters
+    ----------
+    path : str or Path
+        出力先
+    data : bytes
+        書き込むデータ
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
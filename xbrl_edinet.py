@@ -21,12 +21,33 @@ xbrl_edinet.py
 
 import pandas as pd
 from pathlib import Path
+import zipfile
 from zipfile import ZipFile
-import re
 import logging
 logger = logging.getLogger(__name__)
 from lxml import etree
 from datetime import date
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # isal があれば zip の展開 (deflate) に使う (zlib の互換モジュール)
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# XBRL instance の名前空間 (固定)
+XBRLI_NS = "http://www.xbrl.org/2003/instance"
+# context の日付を取り出す XPath (context 毎に path を解釈し直さないように先にコンパイルしておく)
+_XBRLI_NSMAP = {"xbrli" : XBRLI_NS}
+_INSTANT_XPATH = etree.XPath("xbrli:period/xbrli:instant/text()", namespaces=_XBRLI_NSMAP, smart_strings=False)
+_START_DATE_XPATH = etree.XPath("xbrli:period/xbrli:startDate/text()", namespaces=_XBRLI_NSMAP, smart_strings=False)
+_END_DATE_XPATH = etree.XPath("xbrli:period/xbrli:endDate/text()", namespaces=_XBRLI_NSMAP, smart_strings=False)
+
+# parse_zip で XBRL を展開しながら parser に渡す単位
+_XBRL_FEED_SIZE = 1024 * 1024
+# parse_zip が返す DataFrame の列
+_COLUMNS = ("ns_pre", "tag", "context_id", "instant", "start_date", "end_date", "nonconsolidated", "text", "unit")
 
 class XbrlEdinetParseError(RuntimeError):
     pass
@@ -53,19 +74,125 @@ def xbrl_name_info(name):
     info["submission_day"] = date.fromisoformat(name[45:55])# 報告書提出日
     return info
 
+def _open_member(z, name):
+    # zip 内のファイルを開く (isal があれば deflate の展開に使う)
+    fp = z.open(name)
+    if isal_zlib is not None and fp._compress_type == zipfile.ZIP_DEFLATED:
+        # zipfile.zlib を差し替えると圧縮も含めてプロセス全体に影響するので、このファイルの展開にだけ使う
+        fp._decompressor = isal_zlib.decompressobj(-15)
+    return fp
+
+def _find_xbrl_file(z, zip_path):
+    # zip ファイルから XBRL/PublicDoc/*.xbrl ファイル名を取り出す
+    # 対象の xbrl ファイルがない場合、複数ある場合、はとりあえずエラーにする
+    xbrl_file = None
+    prefix = "XBRL/PublicDoc/"
+    for name in z.namelist():
+        if name.startswith(prefix) and name.endswith(".xbrl") and "/" not in name[len(prefix):]:
+            if xbrl_file is not None:
+                raise XbrlEdinetParseError(f"Multiple xbrl files ('XBRL/PublicDoc/*.xbrl') in {zip_path}!")
+            xbrl_file = name
+    if xbrl_file is None:
+        raise XbrlEdinetParseUnexpectedError(f"No xbrl file ('XBRL/PublicDoc/*.xbrl') in {zip_path}!")
+    return xbrl_file
+
+def extract_fields(zip_path, fields):
+    """zip 内の XBRL から指定した値だけを取り出す
+
+    parse_zip と違い DataFrame は作らず、XBRL をストリームで読みながら
+    指定された値が全部揃った時点で読むのをやめる
+
+    Parameters
+    ----------
+    zip_path : str or Path or file-like
+        zip ファイル
+    fields : list
+        (ns_pre, tag) または (ns_pre, tag, context_id) のリスト
+        context_id がない (None の) 場合は context を問わない
+
+    Returns
+    -------
+    dict
+        {field : text} (見つからなかった field は None)
+        同じ field に該当する要素が複数ある場合は最初のものを返す
+    """
+    fields = [tuple(f) for f in fields]
+    found = {}
+    with ZipFile(zip_path) as z:
+        xbrl_file = _find_xbrl_file(z, zip_path)
+        with _open_member(z, xbrl_file) as fp:
+            nsmap = {}
+            wanted = None
+            for event, elem in etree.iterparse(fp, events=("start-ns", "end")):
+                if event == "start-ns":
+                    # ルート要素の名前空間宣言は最初の end より前に全部来る
+                    ns_pre, ns = elem
+                    nsmap.setdefault(ns_pre, ns)
+                    continue
+                if wanted is None:
+                    # "{名前空間}タグ名" -> 該当する field のリスト
+                    wanted = {}
+                    for f in fields:
+                        if f[0] in nsmap:
+                            wanted.setdefault(f"{{{nsmap[f[0]]}}}{f[1]}", []).append(f)
+                for f in wanted.get(elem.tag, ()):
+                    if f in found:
+                        continue
+                    if len(f) > 2 and f[2] is not None and elem.get("contextRef") != f[2]:
+                        continue
+                    found[f] = elem.text
+                if len(found) == len(fields):
+                    break
+                # 読み終わった要素は捨ててメモリを抑える
+                elem.clear()
+                parent = elem.getparent()
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
+    return {f : found.get(f) for f in fields}
+
+# 同じ提出者, 様式の書類を何度も処理するので結果を使い回す
+@lru_cache(maxsize=4096)
+def _target_ns_pres(cabinet_order_code, style_code, report_code, edinet_code, additional_number):
+    # 値を取得する名前空間 (prefix) の tuple
+    return (
+        "jpdei_cor",
+        f"jp{cabinet_order_code}{style_code}-{report_code}_{edinet_code}-{str(additional_number).zfill(3)}",
+        f"jp{cabinet_order_code}_cor",
+        f"jp{cabinet_order_code}-{report_code}_cor",  # 報告書略号が入ってる場合もある？
+        "jppfs_cor",
+    )
+
+def _parse_context(e_content):
+    # context タグ (xbrli) から日付等を取り出す
+    # (context_id, instant, start_date, end_date, nonconsolidated) の tuple を返す
+    id_ = e_content.get("id")
+    # TODO: 区別がつかないものがあるので id 自体をそのまま入れてる。もうちょっとちゃんとできるかも
+    # 日付 (該当する要素がない, または空の場合は空のリストが返る)
+    instant = _INSTANT_XPATH(e_content)
+    start_date = _START_DATE_XPATH(e_content)
+    end_date = _END_DATE_XPATH(e_content)
+    return (
+        id_,
+        instant[0] if instant else None,
+        start_date[0] if start_date else None,
+        end_date[0] if end_date else None,
+        # 非連結かどうか
+        True if "NonConsolidatedMember" in id_ else None,
+    )
+
 def parse_zip(zip_path):
+    # zip_path はファイルパスの他に file-like オブジェクト (io.BytesIO など) も可
     with ZipFile(zip_path) as z:
         # zip ファイルから XBRL/PublicDoc/*.xbrl ファイルを取り出して読む
-        # 対象の xbrl ファイルがない場合、複数ある場合、はとりあえずエラーにする
-        xbrl_file = None
-        for name in z.namelist():
-            if re.match('XBRL/PublicDoc/.*\.xbrl$', name) is not None:
-                if xbrl_file is not None:
-                    XbrlEdinetParseError(f"Multiple xbrl files ('XBRL/Public/*.xbrl') in {zip_path}!")
-                xbrl_file = name
-        if xbrl_file is None:
-            XbrlEdinetParseUnexpectedError(f"No xbrl file ('XBRL/Public/*.xbrl') in {zip_path}!")
-        root = etree.fromstring(z.read(xbrl_file))
+        xbrl_file = _find_xbrl_file(z, zip_path)
+        # 展開後の XBRL 全体を bytes で持たないように少しずつ展開して parser に渡す
+        # (xml:id の索引は使わないので作らない)
+        parser = etree.XMLParser(huge_tree=True, collect_ids=False)
+        with _open_member(z, xbrl_file) as fp:
+            for chunk in iter(lambda: fp.read(_XBRL_FEED_SIZE), b""):
+                parser.feed(chunk)
+        root = parser.close()
         xbrl_name = Path(xbrl_file).name
     logger.debug(f"XBRL filename: {xbrl_name}")
     ninfo = xbrl_name_info(xbrl_name)
@@ -78,56 +205,86 @@ def parse_zip(zip_path):
     #    elements = []
     #    for elem in root.findall(f".//{{{ns}}}*"):
     #        d = {}
-    #        d["tag"] = re.sub("^{[^}]*}", "", elem.tag)
+    #        d["tag"] = elem.tag.rpartition("}")[2]
     #        d["attrib"] = elem.attrib
     #        d["text"] = elem.text
     #        elements.append(d)
     #    df = pd.DataFrame(elements)
     #    df.to_csv(f"debug/{ns_pre}.csv", index=False)
 
-    # context タグを取得 (xbrli)
+    # 値を取得する名前空間
+    target_key = _target_ns_pres(ninfo["cabinet_order_code"], ninfo["style_code"], ninfo["report_code"], ninfo["edinet_code"], ninfo["additional_number"])
+    # 名前空間 -> prefix
+    ns_to_pre = {nsmap[k] : k for k in target_key if k in nsmap}
+
+    # 木を一度だけ走査して context タグ (xbrli) と対象名前空間の値を集める
+    # (対象の要素の絞り込みは lxml 側でやる)
+    xbrli_context = f"{{{XBRLI_NS}}}context"
     contexts = {}
-    for e_content in root.findall(f"./{{{nsmap['xbrli']}}}context"):
-        id_ = e_content.get("id")
-        # TODO: 区別がつかないものがあるので id 自体をそのまま入れてる。もうちょっとちゃんとできるかも
-        c = {"context_id" : id_, "instant" : None, "start_date" : None, "end_date" : None, "nonconsolidated" : None}
-        # 日付
-        e_period = e_content.find(f"./{{{nsmap['xbrli']}}}period")
-        if e_period is not None:
-            for t, s in zip(["instant", "startDate", "endDate"], ["instant", "start_date", "end_date"]):
-                e_date = e_period.find(f"./{{{nsmap['xbrli']}}}{t}")
-                if e_date is not None:
-                    c[s] = e_date.text
-        # 非連結かどうか
-        if "NonConsolidatedMember" in id_:
-            c["nonconsolidated"] = True
-        contexts[id_] = c
+    # 名前空間毎の (tag, contextRef, text, unitRef) のリスト
+    rows = {ns_pre : [] for ns_pre in ns_to_pre.values()}
+    for elem in root.iter(xbrli_context, *(f"{{{ns}}}*" for ns in ns_to_pre)):
+        ns, _, tag = elem.tag[1:].partition("}")
+        ns_pre = ns_to_pre.get(ns)
+        if ns_pre is not None:
+            cref = elem.get("contextRef")
+            if cref is None:
+                # contextRef がないもの (tuple 等の値ではない要素) は飛ばす
+                continue
+            rows[ns_pre].append((tag, cref, elem.text, elem.get("unitRef")))
+        else:
+            c = _parse_context(elem)
+            contexts[c[0]] = c
 
-    # 値を取得する名前空間
-    target_key = []
-    target_key.append("jpdei_cor")
-    target_key.append(f"jp{ninfo['cabinet_order_code']}{ninfo['style_code']}-{ninfo['report_code']}_{ninfo['edinet_code']}-{str(ninfo['additional_number']).zfill(3)}")
-    target_key.append(f"jp{ninfo['cabinet_order_code']}_cor")
-    target_key.append(f"jp{ninfo['cabinet_order_code']}-{ninfo['report_code']}_cor")  # 報告書略号が入ってる場合もある？
-    target_key.append("jppfs_cor")
-    nsmap_target = {k : nsmap[k] for k in target_key if k in nsmap}
-
-    # 値を取得
-    xbrl_data = []
-    for ns_pre, ns in nsmap_target.items():
-        for elem in root.findall(f".//{{{ns}}}*"):
-            d = {"ns_pre" : ns_pre}
-            d["tag"] = re.sub("^{[^}]*}", "", elem.tag)
-            for k, v in contexts[elem.get("contextRef")].items():
-                d[k] = v
-            d["text"] = elem.text
-            d["unit"] = elem.get("unitRef")
-            xbrl_data.append(d)
-    df = pd.DataFrame(xbrl_data)
+    # 値を取得 (context が値より後ろで定義されていても引けるように走査後に対応付ける)
+    # 行毎の dict ではなく列毎のリストにまとめてから DataFrame にする
+    cols = {k : [] for k in _COLUMNS}
+    for ns_pre, ns_rows in rows.items():
+        for tag, cref, text, unit in ns_rows:
+            context_id, instant, start_date, end_date, nonconsolidated = contexts[cref]
+            cols["ns_pre"].append(ns_pre)
+            cols["tag"].append(tag)
+            cols["context_id"].append(context_id)
+            cols["instant"].append(instant)
+            cols["start_date"].append(start_date)
+            cols["end_date"].append(end_date)
+            cols["nonconsolidated"].append(nonconsolidated)
+            cols["text"].append(text)
+            cols["unit"].append(unit)
+    df = pd.DataFrame(cols)
     # 重複データを除く
-    df = df[~df.duplicated()]
+    # context の日付, 非連結フラグは context_id で決まるので比較には含めない
+    df = df.drop_duplicates(subset=["ns_pre", "tag", "context_id", "text", "unit"], ignore_index=True)
     return df
 
+def parse_zips(zip_paths, *, max_workers=None):
+    """複数の zip を multi process で parse_zip して一つの DataFrame にまとめる
+
+    Parameters
+    ----------
+    zip_paths : list of str or Path
+        zip ファイルのリスト
+    max_workers : int, optional
+        プロセス数 (None の場合は CPU 数)
+
+    Returns
+    -------
+    pandas.DataFrame
+        parse_zip の結果を zip_paths の順に連結したもの
+        先頭の "zip_path" 列にどの zip の値かを入れる
+    """
+    zip_paths = [str(p) for p in zip_paths]
+    if not zip_paths:
+        # 空の場合も列は揃えておく
+        return pd.DataFrame(columns=["zip_path", *_COLUMNS])
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        dfs = []
+        # 一つずつだと IPC の回数が多くなるのである程度まとめて渡す
+        for zip_path, df in zip(zip_paths, executor.map(parse_zip, zip_paths, chunksize=4)):
+            df.insert(0, "zip_path", zip_path)
+            dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
 # テストコード
 if __name__ == "__main__":
     logging.basicConfig(